@@ -227,20 +227,33 @@ def standardize_instrument(instrument):
     -------
     std_instr: SimpleNamespace
         It contains the properties above as attributes. They are converted to a
-        float array.
+        float array. If *instrument* is already the output of this function,
+        a shallow copy of it is returned: the arrays are not converted again.
     """
-    std_instr = types.SimpleNamespace()
+    if isinstance(instrument, _StandardInstrument):
+        # New namespace, so that setting attributes does not affect the input
+        return _StandardInstrument(**vars(instrument))
+
+    # Gather the attributes first and build the namespace in one go.
+    # np.array already returns a copy: no need to copy again
+    std_attrs = {}
     for attr in INSTRUMENT_STD_ATTR:
         try:
             try:
                 value = np.array(getattr(instrument, attr), dtype=np.float64)
             except AttributeError:
                 value = np.array(instrument[attr], dtype=np.float64)
-            setattr(std_instr, attr, value.copy())
+            std_attrs[attr] = value
         except (TypeError, KeyError):  # Not subscriptable or missing key
             pass
 
-    return std_instr
+    return _StandardInstrument(**std_attrs)
+
+
+class _StandardInstrument(types.SimpleNamespace):
+    # Output of standardize_instrument: marks instruments that need no further
+    # processing, e.g. when a recipe calls another one
+    pass
 
 
 def _rj2cmb(freqs):
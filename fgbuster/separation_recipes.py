@@ -18,8 +18,10 @@
 
 """
 import logging
+import functools
 import numpy as np
 from scipy.optimize import OptimizeResult
+from scipy.linalg import get_blas_funcs
 import healpy as hp
 from . import algebra as alg
 from .mixingmatrix import MixingMatrix
@@ -35,6 +37,9 @@ __all__ = [
 ]
 
 
+_MASK_CHUNK = 1 << 20  # Pixels scanned at a time by _intersect_mask
+
+
 def weighted_comp_sep(components, instrument, data, cov, nside=0,
                       **minimize_kwargs):
     """ Weighted component separation
@@ -95,45 +100,69 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
     cov_shape = list(np.broadcast(cov, data).shape)
     if cov.ndim < 2 or (data.ndim == 3 and cov.shape[-2] == 1):
         cov_shape[-2] = 1
-    cov = np.broadcast_to(cov, cov_shape, subok=True)
+    # The inverse is computed before broadcasting, on the actual entries of cov
+    invN_diag = np.broadcast_to(1. / hp.pixelfunc.ma_to_array(cov), cov_shape)
 
     # Prepare mask and set to zero all the frequencies in the masked pixels:
     # NOTE: mask are good pixels
-    mask = ~(_intersect_mask(data) | _intersect_mask(cov))
+    mask = _intersect_mask(data)
+    mask |= _intersect_mask(cov)  # Scan only the actual entries of cov
+    mask = ~mask
 
-    invN = np.zeros(cov.shape[:1] + cov.shape)
-    for i in range(cov.shape[0]):
-        invN[i, i] = 1. / cov[i]
-    invN = invN.T
-    if invN.shape[0] != 1:
-        invN = invN[mask]
+    # The noise is diagonal in frequency: rather than building the
+    # (n_freq, n_freq) blocks of invN, keep only its diagonal and use its
+    # square root to prewhiten data and mixing matrix
+    invN_diag = _unbroadcast(invN_diag).T
+    if invN_diag.shape[0] != 1:
+        invN_diag = invN_diag[mask]
+    prewhiten_factors = invN_diag**0.5
 
     data_cs = hp.pixelfunc.ma_to_array(data).T[mask]
-    assert not np.any(hp.ma(data_cs).mask)
+    data_cs *= prewhiten_factors
 
-    A_ev, A_dB_ev, comp_of_param, x0, params = _A_evaluator(components,
-                                                            instrument)
-    if len(x0) == 0:
-        A_ev = A_ev()
+    A_ev, A_dB_ev, comp_of_param, x0, params = _A_evaluator(
+        components, instrument, prewhiten_factors=prewhiten_factors)
 
     # Component separation
     if nside:
-        patch_ids = hp.ud_grade(np.arange(hp.nside2npix(nside)),
-                                hp.npix2nside(data.shape[-1]))[mask]
-        res = alg.multi_comp_sep(A_ev, data_cs, invN, A_dB_ev, comp_of_param,
+        patch_ids = _patch_ids(nside, hp.npix2nside(data.shape[-1]))[mask]
+        if prewhiten_factors.shape[0] != 1:
+            # The prewhitened mixing matrix differs from pixel to pixel:
+            # provide an evaluator for each patch. Sort the pixels by patch
+            # once (stable: within each patch they keep their order) rather
+            # than scanning all the patch_ids for every patch
+            order = np.argsort(patch_ids, kind='stable')
+            patch_prewhiten_factors = np.split(
+                prewhiten_factors[order],
+                np.searchsorted(patch_ids[order],
+                                np.arange(1, patch_ids.max() + 1)))
+            patch_evaluators = [
+                _A_evaluator(components, instrument, patch_factors)
+                for patch_factors in patch_prewhiten_factors]
+            A_ev, A_dB_ev, comp_of_param, _, _ = map(list,
+                                                     zip(*patch_evaluators))
+            if len(x0) == 0:
+                A_ev = [patch_A_ev() for patch_A_ev in A_ev]
+        elif len(x0) == 0:
+            A_ev = A_ev()
+        res = alg.multi_comp_sep(A_ev, data_cs, None, A_dB_ev, comp_of_param,
                                  patch_ids, x0, **minimize_kwargs)
     else:
-        res = alg.comp_sep(A_ev, data_cs, invN, A_dB_ev, comp_of_param, x0,
+        if len(x0) == 0:
+            A_ev = A_ev()
+        res = alg.comp_sep(A_ev, data_cs, None, A_dB_ev, comp_of_param, x0,
                            **minimize_kwargs)
 
     # Craft output
     res.params = params
+    mask_bad = ~mask
 
     def craft_maps(maps):
-        # Unfold the masked maps
+        # Unfold the masked maps (each entry is written only once)
         # Restore the ordering of the input data (pixel dimension last)
-        result = np.full(data.shape[-1:] + maps.shape[1:], hp.UNSEEN)
+        result = np.empty(data.shape[-1:] + maps.shape[1:])
         result[mask] = maps
+        result[mask_bad] = hp.UNSEEN
         return result.T
 
     def craft_params(par_array):
@@ -223,7 +252,9 @@ def basic_comp_sep(components, instrument, data, nside=0, **minimize_kwargs):
     # Prepare mask and set to zero all the frequencies in the masked pixels:
     # NOTE: mask are bad pixels
     mask = _intersect_mask(data)
-    data = hp.pixelfunc.ma_to_array(data).copy()
+    # Floating-point copy: it is prewhitened in place below
+    data = hp.pixelfunc.ma_to_array(data)
+    data = data.astype(np.result_type(data.dtype, np.float64))
     data[..., mask] = 0  # Thus no contribution to the spectral likelihood
 
     try:
@@ -236,15 +267,13 @@ def basic_comp_sep(components, instrument, data, nside=0, **minimize_kwargs):
         components, instrument, prewhiten_factors=prewhiten_factors)
     if len(x0) == 0:
         A_ev = A_ev()
-    if prewhiten_factors is None:
-        prewhitened_data = data.T
-    else:
-        prewhitened_data = prewhiten_factors * data.T
+    prewhitened_data = data.T
+    if prewhiten_factors is not None:
+        prewhitened_data *= prewhiten_factors  # data is already a copy
 
     # Component separation
     if nside:
-        patch_ids = hp.ud_grade(np.arange(hp.nside2npix(nside)),
-                                hp.npix2nside(data.shape[-1]))
+        patch_ids = _patch_ids(nside, hp.npix2nside(data.shape[-1]))
         res = alg.multi_comp_sep(
             A_ev, prewhitened_data, None, A_dB_ev, comp_of_param, patch_ids,
             x0, **minimize_kwargs)
@@ -341,7 +370,9 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
     # Prepare mask and set to zero all the frequencies in the masked pixels:
     # NOTE: mask are bad pixels
     mask = _intersect_mask(data)
-    data = hp.pixelfunc.ma_to_array(data).copy()
+    # Floating-point copy: it is prewhitened in place below
+    data = hp.pixelfunc.ma_to_array(data)
+    data = data.astype(np.result_type(data.dtype, np.float64))
     data[..., mask] = 0  # Thus no contribution to the spectral likelihood
 
     try:
@@ -349,60 +380,83 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
     except TypeError:
         raise ValueError("data has to be a stack of healpix maps")
 
-    invN = _get_prewhiten_factors(instrument, data.shape, data_nside)
-    invN = np.diag(invN**2)
-
-    def array2maps(x):
-        i = 0
-        maps = []
-        for nside in nsides:
-            npix = _my_nside2npix(nside)
-            maps.append(x[i:i+npix])
-            i += npix
-        return maps
+    prewhiten_factors = _get_prewhiten_factors(instrument, data.shape,
+                                               data_nside)
 
+    # For each parameter, index of the pixel of its map that contains each of
+    # the pixels of the max_nside map. Adding the offset of the parameter in x,
+    # unpacking is a gather instead of a ud_grade at every evaluation
+    n_pix_params = [_my_nside2npix(nside) for nside in nsides]
+    param_offsets = np.cumsum([0] + n_pix_params[:-1])
+    pix_of_params = [_patch_ids(nside, max_nside) for nside in nsides]
+    x_ids = np.stack([pix_of_param + offset for pix_of_param, offset
+                      in zip(pix_of_params, param_offsets)])
+
+    # A single gather for all the parameters, then a view for each of them.
+    # The mixing matrix and its derivative are evaluated at the same x, one
+    # after the other: keep the last result and gather only once
     extra_dim = [1]*(data.ndim-1)
-    unpack = lambda x: [
-        _my_ud_grade(m, max_nside).reshape(-1, *extra_dim)
-        for m in array2maps(x)]
+    x_old = [None]
+    params_old = [None]
+
+    def unpack(x):
+        if x_old[0] is None or not np.array_equal(x, x_old[0]):
+            params = x[x_ids].reshape(len(x_ids), -1, *extra_dim)
+            params.flags.writeable = False  # Shared between the evaluations
+            params_old[0] = list(params)
+            x_old[0] = x.copy()
+        return params_old[0]
+
+    array2maps = lambda x: np.split(x, param_offsets[1:])
 
     # Traspose the the data and put the pixels that share the same spectral
     # indices next to each other
     n_pix_max_nside = hp.nside2npix(max_nside)
-    pix_ids = np.argsort(hp.ud_grade(np.arange(n_pix_max_nside), data_nside))
-    data = data.T[pix_ids].reshape(
-        n_pix_max_nside, (data_nside // max_nside)**2, *data.T.shape[1:])
-    back_pix_ids = np.argsort(pix_ids)
+    if data_nside == max_nside:
+        # Each pixel is already alone: no reordering needed
+        back_pix_ids = None
+        data = np.ascontiguousarray(data.T).reshape(
+            n_pix_max_nside, 1, *data.T.shape[1:])
+    else:
+        pix_ids = np.argsort(_patch_ids(max_nside, data_nside), kind='stable')
+        data = data.T[pix_ids].reshape(
+            n_pix_max_nside, (data_nside // max_nside)**2, *data.T.shape[1:])
+        # Inverse permutation, no need for a second sort
+        back_pix_ids = np.empty_like(pix_ids)
+        back_pix_ids[pix_ids] = np.arange(pix_ids.size)
+
+    # The noise is diagonal in frequency: prewhiten data and mixing matrix
+    # (data is already a floating-point copy) rather than passing a dense invN
+    if prewhiten_factors is not None:
+        data *= prewhiten_factors
 
-    A = MixingMatrix(*components)
-    assert A.n_param == len(nsides), (
-        "%i free parameters but %i nsides" % (len(A.defaults), len(nsides)))
-    A_ev = A.evaluator(instrument.frequency, unpack)
-    A_dB_ev = A.diff_evaluator(instrument.frequency, unpack)
-    x0 = [x for c in components for x in c.defaults]
-    x0 = [np.full(_my_nside2npix(nside), px0) for nside, px0 in zip(nsides, x0)]
-    x0 = np.concatenate(x0)
+    A_ev, A_dB_ev, comp_of_param, x0, params = _A_evaluator(
+        components, instrument, prewhiten_factors, unpack)
+    assert len(x0) == len(nsides), (
+        "%i free parameters but %i nsides" % (len(x0), len(nsides)))
+    x0 = np.repeat(x0.astype(float), n_pix_params)
 
     if len(x0) == 0:
         A_ev = A_ev()
 
-    comp_of_dB = [
-        (c_db, _my_ud_grade(np.arange(_my_nside2npix(p_nside)), max_nside))
-        for p_nside, c_db in zip(nsides, A.comp_of_dB)]
+    comp_of_dB = [(c_db, pix_of_param)
+                  for pix_of_param, c_db in zip(pix_of_params, comp_of_param)]
 
     # Component separation
-    res = alg.comp_sep(A_ev, data, invN, A_dB_ev, comp_of_dB, x0,
+    res = alg.comp_sep(A_ev, data, None, A_dB_ev, comp_of_dB, x0,
                        **minimize_kwargs)
 
     # Craft output
     # 1) Apply the mask, if any
     # 2) Restore the ordering of the input data (pixel dimension last)
     def restore_index_mask_transpose(x):
-        x = x.reshape(-1, *x.shape[2:])[back_pix_ids]
+        x = x.reshape(-1, *x.shape[2:])
+        if back_pix_ids is not None:
+            x = x[back_pix_ids]
         x[mask] = hp.UNSEEN
         return x.T
 
-    res.params = A.params
+    res.params = params
     res.s = restore_index_mask_transpose(res.s)
     res.chi = restore_index_mask_transpose(res.chi)
     if 'chi_dB' in res:
@@ -410,11 +464,12 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
             res.chi_dB[i] = restore_index_mask_transpose(res.chi_dB[i])
 
     if len(x0) > 0:
-        x_masks = [_my_ud_grade(mask.astype(float), nside) == 1.
-                   for nside in nsides]
+        # Parameters with the same nside share the mask
+        x_masks = {nside: _my_ud_grade(mask.astype(float), nside) == 1.
+                   for nside in set(nsides)}
         res.x = array2maps(res.x)
-        for x, x_mask in zip(res.x, x_masks):
-            x[x_mask] = hp.UNSEEN
+        for x, nside in zip(res.x, nsides):
+            x[x_masks[nside]] = hp.UNSEEN
 
     res.mask_good = ~mask
     return res
@@ -481,11 +536,11 @@ def harmonic_ilc(components, instrument, data, lbins=None, weights=None, iter=3)
 
     logging.info('Computing alms')
     try:
-        assert np.any(instrument.Beams)
+        assert np.any(instrument.fwhm)
     except (AttributeError, AssertionError):
         beams = None
     else:  # Deconvolve the beam
-        beams = instrument.Beams
+        beams = instrument.fwhm
 
     alms = _get_alms(data, beams, lmax, weights, iter=iter)
 
@@ -493,9 +548,17 @@ def harmonic_ilc(components, instrument, data, lbins=None, weights=None, iter=3)
     res = _harmonic_ilc_alm(components, instrument, alms, lbins, fsky)
 
     logging.info('Back to real')
-    res.s = np.empty((n_comp,) + data.shape[1:], dtype=data.dtype)
-    for c in range(n_comp):
-        res.s[c] = hp.alm2map(alms[c], nside)
+    alms = res.s
+    if alms.ndim > 2 and alms.shape[1] == 3:
+        # TEB -> TQU requires the polarized transform, one component at a time
+        res.s = np.empty((n_comp,) + data.shape[1:], dtype=data.dtype)
+        for c in range(n_comp):
+            res.s[c] = hp.alm2map(alms[c], nside)
+    else:
+        # Scalar transforms: all the components in a single call
+        res.s = hp.alm2map(alms.reshape(-1, alms.shape[-1]), nside, pol=False)
+        res.s = res.s.reshape((n_comp,) + data.shape[1:]).astype(
+            data.dtype, copy=False)
 
     return res
 
@@ -508,50 +571,52 @@ def _get_alms(data, beams=None, lmax=None, weights=None, iter=3):
         else:
             alms.append(hp.map2alm(hp.ma(fdata)*weights, lmax=lmax, iter=iter))
         logging.info(f"{f+1} of {len(data)} complete")
-    alms = np.array(alms)
+    # healpy returns double precision alms: go back to the precision of data
+    alms = np.array(alms, dtype=np.result_type(data.dtype, np.complex64))
 
     if beams is not None:
         logging.info('Correcting alms for the beams')
-        for fwhm, alm in zip(beams, alms):
-            bl = hp.gauss_beam(np.radians(fwhm/60.0), lmax, pol=(alm.ndim==2))
-            if alm.ndim == 1:
-                alm = [alm]
-                bl = [bl]
-
-            for i_alm, i_bl in zip(alm, bl.T):
-                hp.almxfl(i_alm, 1.0/i_bl, inplace=True)
+        lmax = hp.Alm.getlmax(alms.shape[-1])
+        pol = alms.ndim == 3
+        bl = np.array([hp.gauss_beam(np.radians(fwhm/60.0), lmax, pol=pol)
+                       for fwhm in beams])
+        if pol:  # (n_freq, lmax+1, TEB + TE) -> (n_freq, TEB, lmax+1)
+            bl = np.swapaxes(bl, -1, -2)[:, :alms.shape[1]]
+        # Expand the inverse beams to every (l, m) and apply them at once
+        ell = hp.Alm.getlm(lmax)[0]
+        alms *= (1.0 / bl)[..., ell]
 
     return alms
 
 
 def _harmonic_ilc_alm(components, instrument, alms, lbins=None, fsky=None):
-    cl_in = np.array([hp.alm2cl(alm) for alm in alms])
+    cl_in = np.array([_alm2cl(alm) for alm in alms])
 
-    # Multipoles for the ILC bins
     lmax = hp.Alm.getlmax(alms.shape[-1])
-    ell = hp.Alm.getlm(lmax)[0]
-    if lbins is not None:
-        ell = np.digitize(ell, lbins)
     # NOTE: use lmax for indexing alms, ell.max() is the maximum bin index
 
     # Make alms real
     alms = np.asarray(alms, order='C')
-    alms = alms.view(np.float64)
-    alms[..., np.arange(1, 2*(lmax+1), 2)] = hp.UNSEEN  # Mask imaginary m = 0
-    ell = np.stack((ell, ell), axis=-1).reshape(-1)
+    alms = alms.view(alms.real.dtype)
+    alms[..., 1:2*(lmax+1):2] = hp.UNSEEN  # Mask imaginary m = 0
+    n_stokes = None
     if alms.ndim > 2:  # TEB -> ILC indipendently on each Stokes
         n_stokes = alms.shape[1]
         assert n_stokes in [1, 3], "Alms must be either T only or T E B"
-        alms[:, 1:, [0, 2, 2*lmax+2, 2*lmax+3]] = hp.UNSEEN  # EB for ell < 2
-        ell = np.stack([ell] * n_stokes)  # Replicate ell for every Stokes
-        ell += np.arange(n_stokes).reshape(-1, 1) * (ell.max() + 1) # Add offset
+        # EB for ell < 2
+        alms[:, 1:, 0:3:2] = hp.UNSEEN
+        alms[:, 1:, 2*lmax+2:2*lmax+4] = hp.UNSEEN
+
+    lbins_key = None if lbins is None else tuple(np.asarray(lbins).tolist())
+    ell = _real_alm_ell_bins(lmax, lbins_key, n_stokes)
 
     res = ilc(components, instrument, alms, ell)
 
     # Craft output
     res.s[res.s == hp.UNSEEN] = 0.
-    res.s = np.asarray(res.s, order='C').view(np.complex128)
-    cl_out = np.array([hp.alm2cl(alm) for alm in res.s])
+    res.s = np.asarray(res.s, order='C').view(
+        np.result_type(res.s.dtype, np.complex64))
+    cl_out = np.array([_alm2cl(alm) for alm in res.s])
 
     res.cl_in = cl_in
     res.cl_out = cl_out
@@ -573,6 +638,28 @@ def _harmonic_ilc_alm(components, instrument, alms, lbins=None, fsky=None):
     return res
 
 
+def _alm2cl(alm):
+    # hp.alm2cl supports only double precision alms
+    return hp.alm2cl(alm.astype(np.complex128, copy=False))
+
+
+@functools.lru_cache(maxsize=2)
+def _real_alm_ell_bins(lmax, lbins, n_stokes):
+    # ILC bin of each entry of the real view of the alms, depends only on the
+    # arguments: it is cached (and read-only) for repeated calls, e.g. in
+    # Monte Carlo simulations. lbins is a tuple or None. The entries are as
+    # large as the alms: keep only a couple of them
+    ell = hp.Alm.getlm(lmax)[0]
+    if lbins is not None:
+        ell = np.digitize(ell, lbins)
+    ell = np.stack((ell, ell), axis=-1).reshape(-1)
+    if n_stokes is not None:
+        ell = np.stack([ell] * n_stokes)  # Replicate ell for every Stokes
+        ell += np.arange(n_stokes).reshape(-1, 1) * (ell.max() + 1) # Add offset
+    ell.flags.writeable = False
+    return ell
+
+
 def ilc(components, instrument, data, patch_ids=None):
     """ Internal Linear Combination
 
@@ -627,46 +714,64 @@ def ilc(components, instrument, data, patch_ids=None):
 
     data = data.T
     res = OptimizeResult()
-    res.s = np.full(data.shape[:-1] + (n_comp,), hp.UNSEEN)
-
-    def ilc_patch(ids_i, i_patch):
-        if not np.any(ids_i):
-            return
-        data_patch = data[ids_i]  # data_patch is a copy (advanced indexing)
-        cov = np.cov(data_patch.reshape(-1, n_freq).T)
-        # Perform the inversion of the correlation instead of the covariance.
-        # This allows to meaninfully invert covariances that have very noisy
-        # channels.
-        assert cov.ndim == 2
-        cov_regularizer = np.diag(cov)**0.5 * np.diag(cov)[:, np.newaxis]**0.5
-        correlation = cov / cov_regularizer
-        try:
-            inv_freq_cov = np.linalg.inv(correlation) / cov_regularizer
-        except np.linalg.LinAlgError:
-            np.set_printoptions(precision=2)
-            logging.error(
-                f"Empirical covariance matrix cannot be reliably inverted.\n"
-                f"The domain that failed is {i_patch}.\n"
-                f"Covariance matrix diagonal {np.diag(cov)}\n"
-                f"Correlation matrix\n{correlation}")
-            raise
-        res.freq_cov[i_patch] = cov
-        res.W[i_patch] = alg.W(A, inv_freq_cov)
-        res.s[ids_i] = alg._mv(res.W[i_patch], data_patch)
+    # Keep the precision of the data (at least single) for the components.
+    # Covariances and weights are small and are always in double precision:
+    # their inversion is badly conditioned
+    res.s = np.full(data.shape[:-1] + (n_comp,), hp.UNSEEN,
+                    dtype=np.result_type(data.dtype, np.float32))
 
     if patch_ids is None:
-        res.freq_cov = np.full((n_freq, n_freq), hp.UNSEEN)
-        res.W = np.full((n_comp, n_freq), hp.UNSEEN)
-        ilc_patch(mask, np.s_[:])
+        patches = [mask]
     else:
-        n_id = patch_ids.max() + 1
-        res.freq_cov = np.full((n_id, n_freq, n_freq), hp.UNSEEN)
-        res.W = np.full((n_id, n_comp, n_freq), hp.UNSEEN)
-        patch_ids_bak = patch_ids.copy().T
+        patch_ids_bak = np.array(patch_ids.T, order='C')  # Always a copy
         patch_ids_bak[~mask] = -1
-        for i in range(n_id):
-            ids_i = np.where(patch_ids_bak == i)
-            ilc_patch(ids_i, i)
+        # Bucket the entries by patch with a single (stable) sort rather than
+        # scanning all the patch_ids for each patch. Masked entries come first.
+        # Only the flat indices are kept, they are unravelled patch by patch
+        flat_ids = patch_ids_bak.ravel()
+        order = np.argsort(flat_ids, kind='stable')
+        bounds = np.cumsum(np.bincount(flat_ids + 1,
+                                       minlength=patch_ids.max() + 2))
+        patches = [order[start:stop]
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        ids_shape = patch_ids_bak.shape
+        del patch_ids_bak, flat_ids
+    n_id = len(patches)
+    freq_cov = np.full((n_id, n_freq, n_freq), hp.UNSEEN)
+    W = np.full((n_id, n_comp, n_freq), hp.UNSEEN)
+
+    # Empirical covariance of the non-empty patches. Each patch is dropped
+    # right after: keeping them all would hold a copy of the whole data
+    i_patches = []
+    def patch_entries(i_patch):
+        if patch_ids is None:
+            return patches[i_patch]
+        return np.unravel_index(patches[i_patch], ids_shape)
+
+    for i_patch in range(n_id):
+        data_patch = data[patch_entries(i_patch)]  # A copy (advanced indexing)
+        data_patch = data_patch.astype(np.float64, copy=False)
+        if not data_patch.size:
+            continue
+        freq_cov[i_patch] = _empirical_cov(data_patch.reshape(-1, n_freq))
+        i_patches.append(i_patch)
+
+    # The matrices are n_freq x n_freq: invert them and compute the weights of
+    # all the patches at once rather than paying the overhead of the linear
+    # algebra calls patch by patch
+    if i_patches:
+        W[i_patches] = _ilc_weights(A, freq_cov[i_patches], i_patches)
+
+    for i_patch in i_patches:
+        ids_i = patch_entries(i_patch)
+        res.s[ids_i] = alg._mv(W[i_patch], data[ids_i])
+
+    if patch_ids is None:
+        res.freq_cov = freq_cov[0]
+        res.W = W[0]
+    else:
+        res.freq_cov = freq_cov
+        res.W = W
 
     res.s = res.s.T
     res.components = mm.components
@@ -674,6 +779,54 @@ def ilc(components, instrument, data, patch_ids=None):
     return res
 
 
+def _unbroadcast(a):
+    # View of a without the repetitions along its broadcast (zero-stride) axes
+    return a[tuple(slice(None, 1) if stride == 0 else slice(None)
+                   for stride in a.strides)]
+
+
+def _empirical_cov(x):
+    # Same as np.cov(x.T) for x of shape (n_samples, n_freq), but x is centered
+    # in place (it must be a copy) and only the upper triangle of the product
+    # is computed, with a single BLAS syrk call
+    x -= x.mean(axis=0)
+    syrk = get_blas_funcs('syrk', (x,))
+    with np.errstate(divide='ignore'):
+        cov = syrk(np.true_divide(1., x.shape[0] - 1), x.T)
+    return cov + np.triu(cov, 1).T
+
+
+def _ilc_weights(A, cov, i_patches):
+    # ILC weights for a stack of empirical covariances, shape (..., n_freq,
+    # n_freq). i_patches identifies the patches in the error message
+    #
+    # Perform the inversion of the correlation instead of the covariance.
+    # This allows to meaninfully invert covariances that have very noisy
+    # channels.
+    # The inverse is never formed explicitly: W = (A^T X)^-1 X^T, where
+    # X = cov^-1 A is obtained solving the correlation system
+    cov_diag_sqrt = np.diagonal(cov, axis1=-2, axis2=-1)[..., np.newaxis]**0.5
+    cov_regularizer = cov_diag_sqrt * alg._T(cov_diag_sqrt)
+    correlation = cov / cov_regularizer
+    A_reg = A / cov_diag_sqrt
+    try:
+        invN_A = np.linalg.solve(correlation, A_reg) / cov_diag_sqrt
+    except np.linalg.LinAlgError:
+        for i_patch, cov_i, correlation_i, A_reg_i in zip(
+                i_patches, cov, correlation, A_reg):
+            try:
+                np.linalg.solve(correlation_i, A_reg_i)
+            except np.linalg.LinAlgError:
+                np.set_printoptions(precision=2)
+                logging.error(
+                    f"Empirical covariance matrix cannot be reliably inverted.\n"
+                    f"The domain that failed is {i_patch}.\n"
+                    f"Covariance matrix diagonal {np.diag(cov_i)}\n"
+                    f"Correlation matrix\n{correlation_i}")
+        raise
+    return np.linalg.solve(alg._mtm(A, invN_A), alg._T(invN_A))
+
+
 def _get_prewhiten_factors(instrument, data_shape, nside):
     """ Derive the prewhitening factor from the sensitivity
 
@@ -715,10 +868,11 @@ def _get_prewhiten_factors(instrument, data_shape, nside):
         return 12**0.5 * hp.nside2resol(1, arcmin=True) / sens
 
 
-def _A_evaluator(components, instrument, prewhiten_factors=None):
+def _A_evaluator(components, instrument, prewhiten_factors=None, unpack=None):
     A = MixingMatrix(*components)
-    A_ev = A.evaluator(instrument.frequency)
-    A_dB_ev = A.diff_evaluator(instrument.frequency)
+    unpack_arg = () if unpack is None else (unpack,)
+    A_ev = A.evaluator(instrument.frequency, *unpack_arg)
+    A_dB_ev = A.diff_evaluator(instrument.frequency, *unpack_arg)
     comp_of_dB = A.comp_of_dB
     x0 = np.array([x for c in components for x in c.defaults])
     params = A.params
@@ -744,39 +898,131 @@ def _my_nside2npix(nside):
         return 1
 
 
+@functools.lru_cache(maxsize=2)
+def _patch_ids(nside, nside_out):
+    # Index of the pixel of the nside map that contains each of the pixels of
+    # the nside_out map. nside = 0 means a single pixel. The result is cached,
+    # hence read-only. The entries are as large as the nside_out map: keep
+    # only a couple of them
+    ids = _my_ud_grade(np.arange(_my_nside2npix(nside)), nside_out)
+    ids.flags.writeable = False
+    return ids
+
+
 def _my_ud_grade(map_in, nside_out, **kwargs):
     # As healpy.ud_grade, but it accepts map_in of nside = 0 and nside_out = 0,
-    # which in this module means a single float or lenght-1 array
+    # which in this module means a single float or lenght-1 array.
+    # map_in can also be a stack of maps, of shape (..., n_pix): they are
+    # processed together rather than one call per map
     if nside_out == 0:
         try:
             # Both input and output have nside = 0
-            return np.array([float(map_in)])
+            value = float(map_in)
         except TypeError:
-            # This is really clunky...
-            # 1) Downgrade to nside 1
-            # 2) put the 12 values in the pixels of a nside 4 map that belong to
-            #    the same nside 1 pixels
-            # 3) Downgrade to nside 1
-            # 4) pick the value of the pixel in which the 12 values were placed
-            map_in = hp.ud_grade(map_in, 1, **kwargs)
-            out = np.full(hp.nside2npix(4), hp.UNSEEN)
-            ids = hp.ud_grade(np.arange(12), 4, **kwargs)
-            out[np.where(ids == 0)[0][:12]] = map_in
-            kwargs['pess'] = False
-            res = hp.ud_grade(out, 1, **kwargs)
-            return res[:1]
+            # Downgrade to nside 1 and take the mean of the 12 base pixels
+            return _mean_of_base_pixels(_ud_grade_to_nside1(map_in, **kwargs),
+                                        kwargs.get('power'),
+                                        kwargs.get('dtype'))
+        # Floats keep their precision, anything else becomes a double
+        dtype = np.asarray(map_in).dtype
+        return np.array([value], dtype=dtype if dtype.kind == 'f' else float)
+    if np.size(map_in) != 1 and np.shape(map_in)[-1] != 1:
+        if np.ndim(map_in) <= 2:
+            return hp.ud_grade(map_in, nside_out, **kwargs)
+        # healpy takes at most a list of maps: flatten the stack (keeping the
+        # mask of MaskedArrays)
+        map_in = np.asanyarray(map_in)
+        res = hp.ud_grade(map_in.reshape(-1, map_in.shape[-1]), nside_out,
+                          **kwargs)
+        return res.reshape(map_in.shape[:-1] + (-1,))
+    # A uniform map stays uniform: no need to go through healpy
+    map_in = np.atleast_1d(map_in)
+    # Keep the dtype of the input, as healpy does
+    type_out = kwargs.get('dtype') or map_in.dtype
+    if kwargs.get('power'):
+        # Same as the nside 1 -> nside_out upgrade in healpy
+        ratio = float(nside_out) ** float(kwargs['power'])
+        map_in = map_in * (np.ones(1, dtype=type_out) * ratio)
+    return np.repeat(map_in.astype(type_out), hp.nside2npix(nside_out),
+                     axis=-1)
+
+
+def _mean_of_base_pixels(map_in, power=None, dtype=None):
+    # Mean of the good values among the 12 base pixels of each map in
+    # map_in (..., 12), returned as (..., 1). Same result (also with power
+    # and dtype) as placing the 12 values in the nside 4 pixels of the first
+    # base pixel and downgrading to nside 1, but without the 192-pixel maps
+    map_in = np.asarray(map_in, dtype=float)
+    goods = ~(hp.mask_bad(map_in) | ~np.isfinite(map_in))
+    nhit = goods.sum(axis=-1, keepdims=True)
+    map_out = np.sum(map_in, axis=-1, keepdims=True, where=goods)
+    if power:
+        nhit = nhit / 0.25 ** float(power)
+    np.divide(map_out, nhit, out=map_out, where=nhit != 0)
+    map_out[nhit == 0] = hp.UNSEEN
+    return map_out.astype(dtype if dtype else float)
+
+
+def _ud_grade_to_nside1(map_in, pess=False, order_in='RING', order_out=None,
+                        power=None, dtype=None):
+    # As healpy.ud_grade(map_in, 1, ...), but the 12 base pixels of all the
+    # maps in the stack (..., n_pix) are reduced at once on the NESTED maps.
+    # order_out is irrelevant: RING and NESTED coincide at nside 1.
+    # Masked entries become UNSEEN, as they do in healpy
+    map_in = np.asarray(hp.pixelfunc.ma_to_array(map_in))
+    type_out = dtype if dtype else map_in.dtype.type
+    npix = map_in.shape[-1]
+    if npix == 12:  # Already nside 1
+        return map_in.astype(type_out)
+    if str(order_in).upper()[0:4] == 'RING':
+        # Reorder all the maps with a single gather
+        map_in = map_in[..., hp.nest2ring(hp.npix2nside(npix), np.arange(npix))]
+    map_in = map_in.reshape(map_in.shape[:-1] + (12, -1))
+    goods = ~(hp.mask_bad(map_in) | ~np.isfinite(map_in))
+    nhit = goods.sum(axis=-1)
+    bad = nhit != map_in.shape[-1] if pess else nhit == 0
+    # Masked reductions: no temporary copy of the map with the bad pixels zeroed
+    map_out = np.sum(map_in, axis=-1, where=goods).astype(type_out)
+    if power:
+        ratio = (1. / hp.npix2nside(npix)) ** float(power)
+        nhit = nhit / ratio
+    np.divide(map_out, nhit, out=map_out, where=nhit != 0, casting='unsafe')
     try:
-        return hp.ud_grade(np.full(12, map_in.item()),
-                           nside_out, **kwargs)
-    except ValueError:
-        return hp.ud_grade(map_in, nside_out, **kwargs)
+        map_out[bad] = hp.UNSEEN
+    except OverflowError:  # Integer maps, as in healpy
+        pass
+    return map_out.astype(type_out)
 
 
 def _intersect_mask(maps):
-    if hp.pixelfunc.is_ma(maps):
-        mask = maps.mask
-    else:
-        mask = maps == hp.UNSEEN
+    if (not isinstance(maps, np.ndarray)
+            and hasattr(maps, '__array_namespace__')):
+        # Arrays of other libraries (e.g. CuPy or JAX, possibly on GPU) are
+        # reduced with their own routines, without moving them to host memory
+        xp = maps.__array_namespace__()
+        return xp.any(maps == hp.UNSEEN, axis=tuple(range(maps.ndim - 1)))
 
-    # Mask entire pixel if any of the frequencies in the pixel is masked
-    return np.any(mask, axis=tuple(range(maps.ndim-1)))
+    if hp.pixelfunc.is_ma(maps):
+        if np.ma.getmask(maps) is np.ma.nomask:
+            # Nothing is masked: no need to build and scan a full mask
+            return np.zeros(np.shape(maps)[-1:], dtype=bool)
+        mask = np.ma.getmaskarray(maps)
+        # Mask entire pixel if any of the frequencies in the pixel is masked.
+        # Collapse all the leading axes and reduce them in a single pass
+        return mask.reshape(-1, *mask.shape[-1:]).any(axis=0)
+
+    # Same for UNSEEN values, but stream over the single maps (frequencies and
+    # Stokes) rather than materializing maps == UNSEEN for all of them at once.
+    # Chunks of pixels keep the temporaries small also for high-resolution maps
+    maps = np.asarray(maps)
+    n_pix = maps.shape[-1]
+    mask = np.zeros(n_pix, dtype=bool)
+    is_unseen = np.empty(min(n_pix, _MASK_CHUNK), dtype=bool)
+    for start in range(0, n_pix, _MASK_CHUNK):
+        pixels = slice(start, start + _MASK_CHUNK)
+        mask_chunk = mask[pixels]
+        is_unseen_chunk = is_unseen[:mask_chunk.size]
+        for idx in np.ndindex(maps.shape[:-1]):
+            np.equal(maps[idx + (pixels,)], hp.UNSEEN, out=is_unseen_chunk)
+            mask_chunk |= is_unseen_chunk
+    return mask
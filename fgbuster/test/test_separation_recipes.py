@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import os
 import sys
+import warnings
 from itertools import product
 import unittest
+from unittest import mock
 from parameterized import parameterized
 import numpy as np
 from numpy.testing import assert_allclose as aac
@@ -16,6 +18,7 @@ import fgbuster.component_model as cm
 from fgbuster.separation_recipes import (basic_comp_sep, weighted_comp_sep,
                                          multi_res_comp_sep,
                                          _my_ud_grade,
+                                         _intersect_mask,
                                          _my_nside2npix,
                                          ilc, harmonic_ilc)
 
@@ -420,6 +423,37 @@ class TestMultiResCompSep(unittest.TestCase):
             aac(res_x, xx, rtol=2e-5)
 
 
+class TestIntegerMaps(unittest.TestCase):
+    # Integer maps are separated as their floating-point counterparts
+
+    def setUp(self):
+        tag = _make_tag('P', 2, [1], 'powerlaw', 'nomask', 'dict_homo')
+        data, _, _ = _get_sky(tag.split('___')[1])
+        self.data = np.round(data * 100).astype(int)
+        self.instrument = _get_instrument('dict_homo')
+
+    def _components(self):
+        components = _get_component('powerlaw')
+        components[0].defaults = [1.1 * d for d in components[0].defaults]
+        return components
+
+    def test_basic_comp_sep(self):
+        res_int = basic_comp_sep(self._components(), self.instrument,
+                                 self.data, 1)
+        res_float = basic_comp_sep(self._components(), self.instrument,
+                                   self.data.astype(float), 1)
+        aac(res_int.x, res_float.x)
+        aac(res_int.s, res_float.s)
+
+    def test_multi_res_comp_sep(self):
+        res_int = multi_res_comp_sep(self._components(), self.instrument,
+                                     self.data, nsides=[1])
+        res_float = multi_res_comp_sep(self._components(), self.instrument,
+                                       self.data.astype(float), nsides=[1])
+        aac(res_int.x, res_float.x)
+        aac(res_int.s, res_float.s)
+
+
 class TestILC(unittest.TestCase):
 
     def setUp(self):
@@ -538,6 +572,22 @@ class TestILC(unittest.TestCase):
                       data, patch_ids)
         aac(res.s[0], ref, atol=self.TOL)
 
+    def test_T_ids_only_pixel_0(self):
+        # The patch of pixel 0 is the only one left by the mask
+        patch_ids = np.arange(hp.nside2npix(self.NSIDE))
+        data = self.d[:, 0].copy()
+        data[:, 1:] = hp.UNSEEN
+        with suppress_stdout(), np.errstate(invalid='ignore'):
+            res = ilc(self.components, dict(frequency=self.freqs),
+                      data, patch_ids)
+
+        # A single sample gives a degenerate covariance, but the patch is
+        # processed rather than skipped
+        self.assertFalse(np.any(res.W[0] == hp.UNSEEN))
+        self.assertNotEqual(res.s[0, 0], hp.UNSEEN)
+        aac(res.W[1:], hp.UNSEEN)
+        aac(res.s[0, 1:], hp.UNSEEN)
+
 
 class TestHILC(unittest.TestCase):
     def setUp(self):
@@ -628,6 +678,138 @@ class TestHILC(unittest.TestCase):
         # recovery is bad in polarization, mostly at small scales
         aac(res.s[0], self.s*weights, atol=self.TOL*self.s.max())
 
+    def _assert_recovered(self, s_out, s_in):
+        # Residual rms well below the signal rms, for each Stokes
+        rel_rms = np.std(s_out - s_in, axis=-1) / np.std(s_in, axis=-1)
+        aac(rel_rms, 0, atol=0.2)
+
+    def test_TQU_two_components(self):
+        np.random.seed(1)
+        s2 = hp.synfast(self.cl, self.nside, new=True)
+        components = self.components + [cm.PowerLaw(10., -2., units='K_RJ')]
+        d = self.d + components[1].eval(self.freqs).reshape(-1, 1, 1) * s2
+        bins = np.arange(1000) * self.BINS_WIDTH
+
+        with suppress_stdout():
+            res = harmonic_ilc(
+                components, dict(frequency=self.freqs), d,
+                lbins=bins, iter=10)
+
+        # The outputs are the separated components, not the input maps
+        self.assertEqual(res.s.shape, (2,) + self.s.shape)
+        self._assert_recovered(res.s[0], self.s)
+        self._assert_recovered(res.s[1], s2)
+
+    def test_TQU_beams(self):
+        fwhm = np.linspace(90., 60., len(self.freqs))
+        d = np.array([hp.smoothing(d_f, fwhm=np.radians(fwhm_f / 60.))
+                      for d_f, fwhm_f in zip(self.d, fwhm)])
+        bins = np.arange(1000) * self.BINS_WIDTH
+
+        with suppress_stdout():
+            res = harmonic_ilc(
+                self.components, dict(frequency=self.freqs, fwhm=fwhm), d,
+                lbins=bins, iter=10)
+
+        self._assert_recovered(res.s[0], self.s)
+
+    def test_T_beams(self):
+        fwhm = np.linspace(90., 60., len(self.freqs))
+        d = np.array([hp.smoothing(d_f, fwhm=np.radians(fwhm_f / 60.))
+                      for d_f, fwhm_f in zip(self.d[:, 0], fwhm)])
+        bins = np.arange(1000) * self.BINS_WIDTH
+
+        with suppress_stdout():
+            res = harmonic_ilc(
+                self.components, dict(frequency=self.freqs, fwhm=fwhm), d,
+                lbins=bins, iter=10)
+
+        self.assertEqual(res.s.shape, (1, self.npix))
+        self._assert_recovered(res.s[0], self.s[0])
+
+
+class TestMyUdGrade(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.map = np.random.uniform(1., 2., hp.nside2npix(4))
+        # First base pixel entirely bad, second one partially
+        self.map[hp.nest2ring(4, np.arange(16))] = hp.UNSEEN
+        self.map[hp.nest2ring(4, [20, 21])] = hp.UNSEEN
+
+    @parameterized.expand([(False,), (True,)])
+    def test_nside_out_0(self, pess):
+        nside1 = hp.ud_grade(self.map, 1, pess=pess)
+        ref = nside1[nside1 != hp.UNSEEN].mean()
+        aac(_my_ud_grade(self.map, 0, pess=pess), [ref])
+
+    @parameterized.expand([(False,), (True,)])
+    def test_nside_out_0_masked_array(self, pess):
+        np.random.seed(1)
+        map_ma = hp.ma(np.where(self.map == hp.UNSEEN, 1., self.map))
+        # Masked pixels only in the first 6 base pixels
+        mask_nest = np.random.uniform(size=self.map.size) < 0.3
+        mask_nest[96:] = False
+        map_ma.mask = mask_nest[hp.ring2nest(4, np.arange(self.map.size))]
+        # Masked pixels are bad pixels, as in healpy
+        nside1 = hp.pixelfunc.ma_to_array(hp.ud_grade(map_ma, 1, pess=pess))
+        ref = nside1[nside1 != hp.UNSEEN].mean()
+        aac(_my_ud_grade(map_ma, 0, pess=pess), [ref])
+
+    def test_nside_out_0_all_bad(self):
+        self.map[:] = hp.UNSEEN
+        aac(_my_ud_grade(self.map, 0), [hp.UNSEEN])
+
+    def test_nside_out_0_order_out(self):
+        # At nside 0 there is only one pixel, regardless of the ordering
+        aac(_my_ud_grade(self.map, 0, order_out='NESTED'),
+            _my_ud_grade(self.map, 0))
+
+    @parameterized.expand([(0,), (1,), (8,)])
+    def test_stack(self, nside_out):
+        maps = np.stack([self.map, self.map[::-1], 2 * self.map])
+        maps = np.stack([maps, maps[::-1]])
+        res = _my_ud_grade(maps, nside_out)
+        for m, r in zip(maps.reshape(-1, maps.shape[-1]),
+                        res.reshape(-1, res.shape[-1])):
+            aac(r, _my_ud_grade(m, nside_out))
+
+
+class TestIntersectMask(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.maps = np.random.normal(size=(4, 3, 100))
+        self.maps[np.random.uniform(size=self.maps.shape) < 0.02] = hp.UNSEEN
+        self.ref = np.logical_or.reduce(
+            (self.maps == hp.UNSEEN).reshape(-1, 100), axis=0)
+        assert 0 < self.ref.sum() < 100
+
+    @parameterized.expand([(7,), (100,), (1000,)])
+    def test_ndarray(self, chunk):
+        # Chunks that do not divide the number of pixels, or a single one
+        with mock.patch('fgbuster.separation_recipes._MASK_CHUNK', chunk):
+            np.testing.assert_array_equal(_intersect_mask(self.maps), self.ref)
+
+    def test_masked_array_nomask(self):
+        maps = np.ma.MaskedArray(np.where(self.maps == hp.UNSEEN, 0., self.maps))
+        self.assertIs(np.ma.getmask(maps), np.ma.nomask)
+        np.testing.assert_array_equal(_intersect_mask(maps), np.zeros(100, bool))
+
+    def test_masked_array(self):
+        maps = np.ma.masked_equal(self.maps, hp.UNSEEN)
+        np.testing.assert_array_equal(_intersect_mask(maps), self.ref)
+
+    def test_array_api(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Experimental in NumPy 1
+            try:
+                import numpy.array_api as xp
+            except ImportError:
+                self.skipTest('numpy.array_api not available')
+        mask = _intersect_mask(xp.asarray(self.maps))
+        np.testing.assert_array_equal(np.asarray(mask), self.ref)
+
 
 if __name__ == '__main__':
     unittest.main()